@@ -7,14 +7,17 @@ It checks for specific input files and generates processed output files
 if they don't already exist.
 """
 
-import pandas as pd
 import os
+import re
+import struct
 import sys
 from pathlib import Path
 import argparse
-import nibabel as nib
 import json
-from bids import BIDSLayout
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pa_parquet
 import logging
 
 __version__ = "1.0.0"
@@ -23,83 +26,207 @@ __version__ = "1.0.0"
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Input motion columns and the names they are written under
+COLUMN_MAPPING = {
+    'trans_x_mm': 'X',
+    'trans_y_mm': 'Y', 
+    'trans_z_mm': 'Z',
+    'rot_x_degrees': 'RotX',
+    'rot_y_degrees': 'RotY',
+    'rot_z_degrees': 'RotZ',
+    'trans_x_mm_dt': 'XDt',
+    'trans_y_mm_dt': 'YDt',
+    'trans_z_mm_dt': 'ZDt',
+    'rot_x_degrees_dt': 'RotXDt',
+    'rot_y_degrees_dt': 'RotYDt',
+    'rot_z_degrees_dt': 'RotZDt'
+}
+REQUIRED_COLS = tuple(COLUMN_MAPPING)
+NEW_NAMES = list(COLUMN_MAPPING.values())
 
-def process_motion_tsv(input_filepath, output_filepath):
+# Reader options shared by every motion file. Each file is parsed as a single block on
+# one thread, since subject/sessions already run in parallel worker processes. Motion files
+# only hold unquoted numbers, so quote handling is turned off.
+_READ_OPTIONS = pa_csv.ReadOptions(use_threads=False, block_size=8 << 20)
+_PARSE_OPTIONS = pa_csv.ParseOptions(delimiter='\t', quote_char=False, double_quote=False)
+_CONVERT_OPTIONS = pa_csv.ConvertOptions(include_columns=REQUIRED_COLS,
+                                         column_types={col: pa.float32() for col in REQUIRED_COLS})
+
+# Output header line and writer options for the data rows. The header line is written
+# directly since the Arrow writer quotes column names.
+OUTPUT_HEADER = ('\t'.join(NEW_NAMES) + '\n').encode()
+_WRITE_OPTIONS = pa_csv.WriteOptions(include_header=False, delimiter='\t')
+
+# Supported output formats; parquet outputs replace the .tsv suffix with .parquet
+OUTPUT_FORMATS = ('tsv', 'parquet')
+
+# Input → output file patterns generated for each run
+FILE_PATTERNS = [
+    {
+        'input_suffix': '_desc-filteredincludingFD_motion.tsv',
+        'output_suffix': '_desc-filtered_motion.tsv',
+        'description': 'Filtered including FD → Filtered'
+    },
+    {
+        'input_suffix': '_desc-includingFD_motion.tsv', 
+        'output_suffix': '_motion.tsv',
+        'description': 'Including FD → Motion'
+    }
+]
+
+# Data rows are separated by runs of spaces, which the Arrow parser cannot split on
+_WHITESPACE_RUN = re.compile(rb'[ \t]+')
+_EDGE_DELIMITER = re.compile(rb'^\t|\t(?=\r?$)', re.MULTILINE)
+_MISALIGNED_DELIMITER = re.compile(rb' |\t\t|^\t|\t\r?$', re.MULTILINE)
+
+
+def available_cpu_count():
+    """
+    Count the CPUs this process is allowed to run on.
+    
+    On clusters the scheduler usually restricts a job to a subset of the node's CPUs,
+    which os.cpu_count() does not reflect.
+    
+    Returns:
+        int: Number of usable CPUs
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def positive_int(value):
+    """
+    Parse a command line value as a positive integer.
+    
+    Args:
+        value (str): Command line value
+        
+    Returns:
+        int: The parsed value
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: '{value}'")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer: '{value}'")
+    return number
+
+
+def normalize_delimiters(data):
+    """
+    Rewrite whitespace-separated rows as tab-separated rows.
+    
+    Args:
+        data (bytes-like): Raw file contents
+        
+    Returns:
+        bytes: Contents with each run of spaces/tabs replaced by a single tab
+    """
+    return _EDGE_DELIMITER.sub(b'', _WHITESPACE_RUN.sub(b'\t', data))
+
+
+def read_timepoint_count(dtseries_filepath):
+    """
+    Read the number of timepoints of a dtseries file from its NIfTI-2 header.
+    
+    Only the header is read; the CIFTI XML extension and the data are skipped.
+    
+    Args:
+        dtseries_filepath (str): Path to the CIFTI-2 dtseries file
+        
+    Returns:
+        int: Number of timepoints (dim[5] of the NIfTI-2 header)
+    """
+    # sizeof_hdr (int32) at offset 0, dim (int64[8]) at offset 16
+    with open(dtseries_filepath, 'rb') as file:
+        header = file.read(80)
+
+    if len(header) == 80:
+        for byteorder in '<>':
+            if struct.unpack_from(f'{byteorder}i', header)[0] == 540:
+                return struct.unpack_from(f'{byteorder}8q', header, 16)[5]
+
+    raise ValueError(f"Not a NIfTI-2 file: {dtseries_filepath}")
+
+
+def process_motion_tsv(input_filepath, output_filepath, output_format='tsv'):
     """
     Process motion TSV file by extracting specific columns and renaming them.
     
     Args:
         input_filepath (str): Path to input TSV file
-        output_filepath (str): Path to output TSV file
+        output_filepath (str): Path to output TSV or Parquet file
+        output_format (str): Output format, 'tsv' or 'parquet'
         
     Returns:
         bool: True if successful, False if failed
     """
     
-    # Define column mapping
-    column_mapping = {
-        'trans_x_mm': 'X',
-        'trans_y_mm': 'Y', 
-        'trans_z_mm': 'Z',
-        'rot_x_degrees': 'RotX',
-        'rot_y_degrees': 'RotY',
-        'rot_z_degrees': 'RotZ',
-        'trans_x_mm_dt': 'XDt',
-        'trans_y_mm_dt': 'YDt',
-        'trans_z_mm_dt': 'ZDt',
-        'rot_x_degrees_dt': 'RotXDt',
-        'rot_y_degrees_dt': 'RotYDt',
-        'rot_z_degrees_dt': 'RotZDt'
-    }
-    
     try:
-        # Read the file headers to get column names
-        with open(input_filepath, 'r') as file:
-            header_line = file.readline().strip()
-            headers = header_line.split('\t')
+        # Map the file instead of reading it into a bytes copy; the header row and the
+        # data rows are parsed together
+        with pa.memory_map(input_filepath) as mapped:
+            if mapped.size() == 0:
+                logger.error(f"  The file is empty: {input_filepath}")
+                return False
+            data = mapped.read_buffer()
 
-        logger.debug(f"  Detected columns: {headers}")
+            # Rows that are already single-tab separated are parsed straight from the mapping
+            if _MISALIGNED_DELIMITER.search(data):
+                data = pa.py_buffer(normalize_delimiters(data))
 
-        # Reload the data, skipping the header
-        df_split = pd.read_csv(input_filepath, sep='   ', header=None, skiprows=1, engine='python')
-
-        # Assign headers to the new DataFrame
-        df_split.columns = headers
+            try:
+                table = pa_csv.read_csv(data, read_options=_READ_OPTIONS,
+                                        parse_options=_PARSE_OPTIONS, convert_options=_CONVERT_OPTIONS)
+            except KeyError:
+                # A required column is not in the header row
+                headers = data.to_pybytes().split(b'\n', 1)[0].decode().split()
+                missing_cols = [col for col in REQUIRED_COLS if col not in headers]
+                logger.error(f"  Missing required columns: {missing_cols}")
+                logger.error(f"  Available columns in file: {headers}")
+                return False
+            except pa.ArrowInvalid:
+                # A file holding only blank lines has no header row for Arrow to parse
+                if not data.to_pybytes().strip():
+                    logger.error(f"  The file is empty: {input_filepath}")
+                    return False
+                raise
 
-        # Validate required columns
-        required_cols = list(column_mapping.keys())
-        missing_cols = [col for col in required_cols if col not in df_split.columns]
-        if missing_cols:
-            logger.error(f"  Missing required columns: {missing_cols}")
-            logger.error(f"  Available columns in file: {list(df_split.columns)}")
+        if table.num_rows == 0:
+            logger.error(f"  The file is empty: {input_filepath}")
             return False
-        
-        # Select and rename the required columns
-        df_filtered = df_split[required_cols].rename(columns=column_mapping)
-        
-        # Save the processed data
-        logger.info(f"  Saving processed data to: {output_filepath}")
-        df_filtered.to_csv(output_filepath, sep='\t', index=False)
+
+        # Save the processed data under the renamed headers
+        logger.debug(f"  Saving processed data to: {output_filepath}")
+        if output_format == 'parquet':
+            pa_parquet.write_table(table.rename_columns(NEW_NAMES), output_filepath, compression='zstd')
+        else:
+            # A 1 MiB buffer lets the header and all data rows go out in a few write() calls
+            with open(output_filepath, 'wb', buffering=1 << 20) as file:
+                file.write(OUTPUT_HEADER)
+                pa_csv.write_csv(table, file, write_options=_WRITE_OPTIONS)
         
         # Log summary
-        logger.info(f"  Processing completed successfully!")
-        # logger.info(f"  Rows processed: {len(df_filtered)}")
-        # logger.info(f"  Columns extracted: {len(df_filtered.columns)}")
+        logger.debug(f"  Processing completed successfully!")
+        # logger.info(f"  Rows processed: {table.num_rows}")
+        # logger.info(f"  Columns extracted: {table.num_columns}")
         
         return True
         
     except FileNotFoundError:
         logger.error(f"  File not found: {input_filepath}")
         return False
-    except pd.errors.EmptyDataError:
-        logger.error(f"  The file is empty: {input_filepath}")
+    except pa.ArrowInvalid as e:
+        logger.error(f"  Could not parse {input_filepath}: {str(e)}")
         return False
     except Exception as e:
         logger.error(f"  Error processing file: {str(e)}")
         return False
 
 
-def process_subject_session(derivative_dir, subject, session):
+def process_subject_session(derivative_dir, subject, session, output_format='tsv'):
     """
     Process motion files for a specific subject/session combination.
     
@@ -107,38 +234,40 @@ def process_subject_session(derivative_dir, subject, session):
         derivative_dir (str): Root BIDS directory
         subject (str): Subject ID (e.g., 'sub-01')
         session (str): Session ID (e.g., 'ses-01')
+        output_format (str): Output format, 'tsv' or 'parquet'
     """
     
     # Construct the func directory path
     func_dir = Path(derivative_dir) / subject / session / 'func'
     
-    if not func_dir.exists():
+    # List the directory once; all file existence checks for the session use this set
+    try:
+        existing_files = frozenset(entry.name for entry in os.scandir(func_dir))
+    except (FileNotFoundError, NotADirectoryError):
         logger.error(f"func directory does not exist: {func_dir}")
         return
     
-    dtseries = func_dir / f"{subject}_{session}_task-rest_bold_desc-filtered_timeseries.dtseries.nii"
+    dtseries_filename = f"{subject}_{session}_task-rest_bold_desc-filtered_timeseries.dtseries.nii"
+    dtseries = func_dir / dtseries_filename
 
-    if not dtseries.exists():
+    if dtseries_filename not in existing_files:
         logger.error(f"dtseries file does not exist: {dtseries}")
         return
     
-    # Load the file
-    img = nib.load(str(dtseries))
-
-    # Get the shape - for dtseries, this is typically (timepoints, vertices/voxels)
-    # logger.info(f"Shape: {img.shape}")
-    logger.info(f" Number of timepoints: {img.shape[0]}")
+    # Get the number of timepoints - for dtseries, the shape is typically (timepoints, vertices/voxels)
+    timepoints = read_timepoint_count(dtseries)
+    logger.info(f" Number of timepoints: {timepoints}")
 
-    run_counts = img.shape[0] // 383
+    run_counts = timepoints // 383
     logger.info(f" Number of rest runs: {run_counts}")
 
     for run in range(1, run_counts + 1):
         run_str = f"run-{run:02d}"
         task = 'rest'
-        process_run(func_dir, subject, session, task, run_str)
+        process_run(func_dir, subject, session, task, run_str, existing_files, output_format)
 
 
-def process_run(func_dir, subject, session, task, run):
+def process_run(func_dir, subject, session, task, run, existing_files, output_format='tsv'):
     """
     Process motion files for a specific run.
     
@@ -148,53 +277,46 @@ def process_run(func_dir, subject, session, task, run):
         session (str): Session ID
         task (str): Task name
         run (str): Run identifier
+        existing_files (frozenset): Names of the files in func_dir
+        output_format (str): Output format, 'tsv' or 'parquet'
     """
     logger.info(f"  Processing: {subject}/{session}/func/ - task: {task}, run: {run}")
     new_run = run.replace('run-0', 'run-')
     
-    # Base filename pattern
-    base_filename = f"{subject}_{session}_task-{task}"
-    
-    # Define file patterns to check
-    file_patterns = [
-        {
-            'input_suffix': '_desc-filteredincludingFD_motion.tsv',
-            'output_suffix': '_desc-filtered_motion.tsv',
-            'description': 'Filtered including FD → Filtered'
-        },
-        {
-            'input_suffix': '_desc-includingFD_motion.tsv', 
-            'output_suffix': '_motion.tsv',
-            'description': 'Including FD → Motion'
-        }
-    ]
+    # Base filename patterns for the input and output files of this run
+    input_base = f"{subject}_{session}_task-{task}_{run}"
+    output_base = f"{subject}_{session}_task-{task}_{new_run}"
     
     processed_count = 0
     
-    for pattern in file_patterns:
-        input_filename = base_filename + f'_{run}' + pattern['input_suffix']
-        output_filename = base_filename + f'_{new_run}' + pattern['output_suffix']
-        
-        input_filepath = func_dir / input_filename
-        output_filepath = func_dir / output_filename
+    # Names are checked against the session listing first; paths are only built for the
+    # files that are actually processed
+    for pattern in FILE_PATTERNS:
+        output_suffix = pattern['output_suffix']
+        if output_format == 'parquet':
+            output_suffix = output_suffix.replace('.tsv', '.parquet')
+        input_filename = input_base + pattern['input_suffix']
+        output_filename = output_base + output_suffix
         
-        logger.info(f"  Checking pattern: {pattern['description']}")
-        logger.debug(f"  Input file: {input_filename}")
-        logger.debug(f"  Output file: {output_filename}")
+        # Per-file details are only formatted when debug logging is enabled
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"  Checking pattern: {pattern['description']}")
+            logger.debug(f"  Input file: {input_filename}")
+            logger.debug(f"  Output file: {output_filename}")
         
         # Check if input file exists
-        if not input_filepath.exists():
+        if input_filename not in existing_files:
             logger.warning(f"  Input file does not exist, skipping...")
             continue
             
         # Check if output file already exists
-        if output_filepath.exists():
-            logger.info(f"  Output file already exists, skipping...")
+        if output_filename in existing_files:
+            logger.debug(f"  Output file already exists, skipping...")
             continue
         
         # Process the file
-        logger.info(f"  Processing {pattern['description']}...")
-        if process_motion_tsv(str(input_filepath), str(output_filepath)):
+        logger.debug(f"  Processing {pattern['description']}...")
+        if process_motion_tsv(str(func_dir / input_filename), str(func_dir / output_filename), output_format):
             processed_count += 1
         else:
             logger.error(f"  Failed to process {input_filename}")
@@ -205,61 +327,100 @@ def process_run(func_dir, subject, session, task, run):
         logger.info(f"No files needed processing for {subject}/{session} \n")
 
 
-def run_participant_level(derivative_dir, analysis_level, participant_labels, session_labels):
+def list_sessions(subject_dir):
+    """
+    List the session directories of a subject.
+    
+    Args:
+        subject_dir (Path): Path to the subject directory
+        
+    Returns:
+        frozenset: Session directory names (e.g., 'ses-01'), or None if the subject
+            directory does not exist
+    """
+    try:
+        return frozenset(d.name for d in os.scandir(subject_dir)
+                         if d.is_dir() and d.name.startswith('ses-'))
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def run_participant_level(derivative_dir, analysis_level, participant_labels, session_labels, output_format='tsv',
+                          n_cpus=None):
     """
     Run participant level analysis.
     
     Args:
         derivative_dir (str): BIDS input directory
         participant_labels (list): List of participant labels to process
+        output_format (str): Output format, 'tsv' or 'parquet'
+        n_cpus (int): Number of subject/session combinations processed in parallel
+            (defaults to the number of CPUs available to the process)
     """
     logger.info(f"Starting {analysis_level} level analysis")
     
+    # Session directories of each subject, scanned once per subject
+    subject_sessions = {}
+
     # Get all subjects if none specified
     if analysis_level == 'group':
-        bids_layout = BIDSLayout(derivative_dir, validate=False)
         logger.info(f"Processing all participants and sessions in {derivative_dir}")
-        participant_labels = [s.replace('sub-', '') for s in bids_layout.get_subjects()]
-        all_sessions = set()
+        # Only the subject directories are needed, so list them instead of indexing the whole dataset
+        participant_labels = sorted(d.name[4:] for d in os.scandir(derivative_dir)
+                                    if d.is_dir() and d.name.startswith('sub-'))
         for participant_label in participant_labels:
-            subject = f"sub-{participant_label}"
-            subject_dir = Path(derivative_dir) / subject
-            if subject_dir.exists():
-                session_dirs = [d.name for d in subject_dir.iterdir() 
-                                if d.is_dir() and d.name.startswith('ses-')]
-                all_sessions.update([s.replace('ses-', '') for s in session_dirs])
-        session_labels = sorted(list(all_sessions))
-        # logger.info(f"Found sessions: {session_labels}")
+            subject_sessions[participant_label] = list_sessions(Path(derivative_dir) / f"sub-{participant_label}")
     else:
         if not participant_labels or not session_labels:
             logger.error("Participant labels or session labels not specified for participant level analysis")
             sys.exit(1)
         logger.info(f"Processing specified participants: {participant_labels}")
     
+    jobs = []
     for participant_label in participant_labels:
-        for session_label in session_labels:
-            subject = f"sub-{participant_label}"
-            session = f"ses-{session_label}" 
-            logger.info(f" Processing participant: {subject}")
-            
-            # Find all sessions for this subject
-            subject_dir = Path(derivative_dir) / subject
-            session_dir =  Path(subject_dir) / session
-            if not subject_dir.exists():
-                logger.warning(f" Subject directory does not exist: {subject_dir}")
-                continue
-    
-            if not session_labels:
-                logger.warning(f" No session directories found for {subject}")
+        subject = f"sub-{participant_label}"
+        logger.info(f" Processing participant: {subject}")
+        
+        # Find all sessions for this subject
+        subject_dir = Path(derivative_dir) / subject
+        if participant_label not in subject_sessions:
+            subject_sessions[participant_label] = list_sessions(subject_dir)
+        sessions_on_disk = subject_sessions[participant_label]
+        if sessions_on_disk is None:
+            logger.warning(f" Subject directory does not exist: {subject_dir}")
+            continue
+
+        if not sessions_on_disk:
+            logger.warning(f" No session directories found for {subject}")
+            continue
+
+        # Group level processes whatever sessions each subject has; only sessions named
+        # on the command line are reported when missing
+        if analysis_level == 'group':
+            sessions = sorted(sessions_on_disk)
+        else:
+            sessions = [f"ses-{session_label}" for session_label in session_labels]
+
+        for session in sessions:
+            if session not in sessions_on_disk:
+                logger.warning(f" Session directory does not exist: {subject_dir / session}")
                 continue
             
             logger.info(f" Processing session: {session}")
-            
+            jobs.append((subject, session))
+
+    # Each subject/session reads and writes its own files, so they can run in parallel
+    if n_cpus is None:
+        n_cpus = available_cpu_count()
+    with ProcessPoolExecutor(max_workers=n_cpus) as executor:
+        futures = {executor.submit(process_subject_session, derivative_dir, subject, session, output_format):
+                   (subject, session) for subject, session in jobs}
+        for future in as_completed(futures):
+            subject, session = futures[future]
             try:
-                process_subject_session(derivative_dir,subject, session)
+                future.result()
             except Exception as e:
                 logger.error(f" Error processing {subject}/{session}: {str(e)}")
-                continue
 
 
 def main():
@@ -294,6 +455,11 @@ def main():
     parser.add_argument('--participant_label', 
                        nargs='+',
                        help='The label(s) of the participant(s) that should be analyzed. The label corresponds to sub-<participant_label> from the BIDS spec (so it does not include "sub-"). If this parameter is not provided all subjects should be analyzed. Multiple participants can be specified with a space separated list.')
+    parser.add_argument('--output_format',
+                       choices=OUTPUT_FORMATS, default='tsv',
+                       help='Format of the generated motion files. "parquet" writes zstd-compressed Parquet files with a .parquet suffix instead of .tsv. Defaults to "tsv".')
+    parser.add_argument('--n_cpus', type=positive_int,
+                       help='Number of subject/session combinations to process in parallel. If this parameter is not provided all available CPUs are used.')
     parser.add_argument('-v', '--version', 
                        action='version', 
                        version=f'TSV Motion Data Processor v{__version__}')
@@ -311,7 +477,8 @@ def main():
     # Run the appropriate analysis level
     try:
         if args.analysis_level :
-            run_participant_level(derivative_dir, args.analysis_level, args.participant_label, args.session_label)
+            run_participant_level(derivative_dir, args.analysis_level, args.participant_label, args.session_label,
+                                  args.output_format, args.n_cpus)
         else:
             logger.error(f"Unknown analysis level: {args.analysis_level}")
             sys.exit(1)